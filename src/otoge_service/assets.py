@@ -0,0 +1,109 @@
+import csv
+import json
+import time
+import typing
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+
+from pydantic import ValidationError
+from sqlalchemy import MetaData, Table, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import SQLModel
+
+from otoge_service import sessions
+from otoge_service.loggings import Ansi, log, magnitude_fmt_time
+from otoge_service.models import AssetVersion, ChunithmCharacter, MaimaiCharacter, OngekiCard, OngekiSkill
+
+T = typing.TypeVar("T")
+
+asset_models: dict[str, type[SQLModel]] = {
+    "maimai-characters": MaimaiCharacter,
+    "ongeki-cards": OngekiCard,
+    "ongeki-skills": OngekiSkill,
+    "chunithm-characters": ChunithmCharacter,
+}
+
+
+def read_rows(path: Path, format: str | None = None) -> typing.Iterator[dict[str, typing.Any]]:
+    """Stream rows from a CSV, JSON lines or JSON array file, the format is guessed from the suffix if omitted."""
+    format = format or path.suffix.lstrip(".").lower()
+    with path.open(encoding="utf-8-sig", newline="") as f:
+        if format == "csv":
+            yield from csv.DictReader(f)
+        elif format in ("jsonl", "ndjson"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif format == "json":
+            # a JSON array can't be streamed without a third-party parser, prefer JSON lines for large sources
+            yield from json.load(f)
+        else:
+            raise ValueError(f"Unsupported asset format: {format}")
+
+
+def validate_rows(model: type[SQLModel], rows: typing.Iterable[dict[str, typing.Any]]) -> typing.Iterator[dict[str, typing.Any]]:
+    primary_key = [column.name for column in model.__table__.primary_key]  # type: ignore
+    seen_keys: set[tuple] = set()
+    for row_number, row in enumerate(rows, start=1):
+        # empty cells of optional fields are missing values, let the model defaults decide
+        row = {k: v for k, v in row.items() if v != "" or (k in model.model_fields and model.model_fields[k].is_required())}
+        try:
+            validated = model.model_validate(row).model_dump()
+        except ValidationError as e:
+            raise ValueError(f"Invalid row {row_number} for {model.__tablename__}: {e}") from e
+        key = tuple(validated[name] for name in primary_key)
+        if None not in key:
+            if key in seen_keys:
+                raise ValueError(f"Invalid row {row_number} for {model.__tablename__}: duplicate primary key {key}")
+            seen_keys.add(key)
+        yield validated
+
+
+def _batched(rows: typing.Iterable[T], batch_size: int) -> typing.Iterator[list[T]]:
+    iterator = iter(rows)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+async def import_assets(name: str, path: Path, format: str | None = None, batch_size: int = 1000, allow_empty: bool = False) -> int:
+    """Load an asset file into a staging table in batches, then swap it into the asset table atomically.
+
+    Readers keep seeing the previous rows until the swap commits, and the asset version is bumped in
+    the same transaction. An empty source is refused unless `allow_empty`, as it would wipe the table.
+    Returns the number of imported rows.
+    """
+    model = asset_models[name]
+    table: Table = model.__table__  # type: ignore
+    versions: Table = AssetVersion.__table__  # type: ignore
+    staging = table.to_metadata(MetaData(), name=f"{table.name}_staging")
+
+    await sessions.init_db()
+    begin, count = time.perf_counter_ns(), 0
+    async with sessions.get_async_engine().begin() as conn:
+        await conn.run_sync(staging.drop, checkfirst=True)
+        await conn.run_sync(staging.create)
+    try:
+        for batch in _batched(validate_rows(model, read_rows(path, format)), batch_size):
+            try:
+                async with sessions.get_async_engine().begin() as conn:
+                    await conn.execute(insert(staging), batch)  # executemany
+            except IntegrityError as e:
+                raise ValueError(f"Invalid rows {count + 1}-{count + len(batch)} for {table.name}: {e.orig}") from e
+            count += len(batch)
+        if count == 0 and not allow_empty:
+            raise ValueError(f"No rows found in {path}, pass --allow-empty to empty {table.name}")
+        async with sessions.get_async_engine().begin() as conn:
+            await conn.execute(delete(table))
+            await conn.execute(insert(table).from_select([c.name for c in staging.columns], select(staging)))
+            # bump the asset version in the swap transaction, so caches keyed by it are invalidated with the rows
+            bumped = await conn.execute(
+                update(versions).where(versions.c.name == name).values(version=versions.c.version + 1, updated_at=datetime.utcnow())
+            )
+            if bumped.rowcount == 0:
+                await conn.execute(insert(versions).values(name=name, version=1, updated_at=datetime.utcnow()))
+    finally:
+        async with sessions.get_async_engine().begin() as conn:
+            await conn.run_sync(staging.drop, checkfirst=True)
+    log(f"Imported {count} rows into {table.name} in {magnitude_fmt_time(time.perf_counter_ns() - begin)}", Ansi.LGREEN)
+    return count
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import importlib
+from pathlib import Path
+
+from otoge_service import profiling
+from otoge_service.settings import get_settings
+
+settings = get_settings()
+asset_names = ["maimai-characters", "ongeki-cards", "ongeki-skills", "chunithm-characters"]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="otoge-service")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve", help="run the API server (default)")
+    import_parser = subparsers.add_parser("import-assets", help="import an asset table from a CSV or JSON file")
+    import_parser.add_argument("table", choices=asset_names)
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument("--format", choices=["csv", "json", "jsonl"], default=None, help="guessed from the suffix by default")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--allow-empty", action="store_true", help="empty the table if the source has no rows")
+    reshard_parser = subparsers.add_parser("reshard", help="move usagicard players from their previous score shard to their current one")
+    reshard_parser.add_argument("--dry-run", action="store_true", help="only count the players to move")
+    profile_parser = subparsers.add_parser("profile-startup", help="report import and init times of building the app")
+    profile_parser.add_argument("--budget", type=float, default=None, help="fail if startup takes longer (in seconds)")
+    args = parser.parse_args()
+
+    if args.command == "import-assets":
+        from otoge_service import assets
+
+        try:
+            asyncio.run(assets.import_assets(args.table, args.path, args.format, args.batch_size, args.allow_empty))
+        except (OSError, ValueError) as e:
+            parser.exit(1, f"Failed to import {args.table}: {e}\n")
+    elif args.command == "reshard":
+        from otoge_service import shards
+
+        try:
+            asyncio.run(shards.reshard(args.dry_run))
+        except ValueError as e:
+            parser.exit(1, f"Failed to reshard: {e}\n")
+    elif args.command == "profile-startup":
+        profiling.install()
+        with profiling.profile_step("import otoge_service.entrypoint"):
+            importlib.import_module("otoge_service.entrypoint")
+        elapsed = profiling.report() / 1e9
+        if args.budget is not None and elapsed > args.budget:
+            parser.exit(1, f"Startup took {elapsed:.2f}s, over the budget of {args.budget:.2f}s\n")
+    else:
+        import uvicorn
+
+        if settings.profile_startup:
+            profiling.install()  # reported by the lifespan once startup completes
+        uvicorn.run("otoge_service.entrypoint:asgi_app", port=settings.bind_port, host=settings.bind_host)
@@ -2,17 +2,16 @@ import asyncio
 import json
 from contextlib import asynccontextmanager
 
-import uvicorn
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.openapi.utils import get_openapi
-from maimai_py import MaimaiPyError
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
 
-from otoge_service import sessions
+from otoge_service import profiling, sessions, traces, usages
 from otoge_service.exceptions import LeporidException
+from otoge_service.loggings import Ansi, log
 from otoge_service.settings import get_settings
 
 settings = get_settings()
@@ -20,7 +19,12 @@ settings = get_settings()
 
 class SuccessResponseMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        response = await call_next(request)
+        with traces.span("middleware", "SuccessResponseMiddleware"):
+            response = await call_next(request)
+            with traces.span("serialization", "SuccessResponseMiddleware"):
+                return await self.wrap(request, response)
+
+    async def wrap(self, request: Request, response: Response) -> Response:
         if request.url.path.endswith("/openapi.json"):
             return response
         if not 200 <= response.status_code < 300:
@@ -47,14 +51,61 @@ class SuccessResponseMiddleware(BaseHTTPMiddleware):
         return wrapped_response
 
 
+class ConcurrencyLimitMiddleware(BaseHTTPMiddleware):
+    """Shed requests with 503 once `max_concurrent_requests` are in flight, instead of queueing them."""
+
+    def __init__(self, app, max_concurrent_requests: int) -> None:
+        super().__init__(app)
+        self.max_concurrent_requests = max_concurrent_requests
+        self.in_flight = 0
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        if self.in_flight >= self.max_concurrent_requests:
+            return LeporidException.SERVICE_UNAVAILABLE.msg("服务繁忙，请稍后重试").after(1).as_response()
+        self.in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            self.in_flight -= 1
+
+
 @asynccontextmanager
 async def init_lifespan(asgi_app: FastAPI):
-    asyncio.create_task(sessions.maimai_client.songs())
-    await sessions.init_db()
+    if settings.maimai_providers or settings.enable_maimai_assets:
+        asyncio.create_task(sessions.get_maimai_client().songs())
+    with profiling.profile_step("init_db"):
+        await sessions.init_db()
     if settings.enable_developer_check:
-        await sessions.init_developers()
+        with profiling.profile_step("init_developers"):
+            await sessions.init_developers()
+        developers_watcher = asyncio.create_task(sessions.watch_developers())
+        usages_flusher = asyncio.create_task(usages.flush_usages_periodically())
+    if settings.enable_usagicard_sync:
+        from otoge_service import syncs
+
+        sync_scheduler = asyncio.create_task(syncs.run_scheduler())
+    if profiling.enabled:
+        profiling.report()
     yield  # Above: Startup process Below: Shutdown process
-    await sessions.async_engine.dispose()
+    if settings.enable_usagicard_sync:
+        sync_scheduler.cancel()
+        await asyncio.gather(sync_scheduler, return_exceptions=True)
+    if settings.enable_developer_check:
+        developers_watcher.cancel()
+        usages_flusher.cancel()
+        # a flush cancelled mid-write restores its counts, so the final flush must run after it settled
+        await asyncio.gather(developers_watcher, usages_flusher, return_exceptions=True)
+        try:
+            await usages.flush_usages()
+        except Exception as e:
+            log(f"Failed to flush developer usages on shutdown: {e!r}", Ansi.LRED)
+    if settings.usagicard_write_behind:
+        from otoge_service.providers.usagicard import score_write_buffer
+
+        await score_write_buffer.flush_all()  # type: ignore
+    if traces.dump_task is not None:
+        await traces.dump_task  # append the traces still pending to the dump file
+    await sessions.dispose_engines()
 
 
 def init_routes(asgi_app: FastAPI) -> None:
@@ -68,9 +119,12 @@ def init_routes(asgi_app: FastAPI) -> None:
 
 
 def init_exception_handlers(asgi_app: FastAPI) -> None:
-    @asgi_app.exception_handler(MaimaiPyError)
-    async def maimai_py_error_handler(request, exception: MaimaiPyError):
-        return LeporidException.BAD_REQUEST.msg(repr(exception)).as_response()
+    if settings.maimai_providers or settings.enable_maimai_assets:
+        from maimai_py import MaimaiPyError
+
+        @asgi_app.exception_handler(MaimaiPyError)
+        async def maimai_py_error_handler(request, exception: MaimaiPyError):
+            return LeporidException.BAD_REQUEST.msg(repr(exception)).as_response()
 
     @asgi_app.exception_handler(RequestValidationError)
     async def validation_exception_handler(request, error: RequestValidationError):
@@ -90,6 +144,12 @@ def init_exception_handlers(asgi_app: FastAPI) -> None:
 
 def init_middleware(asgi_app: FastAPI) -> None:
     asgi_app.add_middleware(SuccessResponseMiddleware)
+    if settings.enable_flight_recorder:
+        traces.install()
+        asgi_app.add_middleware(traces.FlightRecorderMiddleware)
+    if settings.max_concurrent_requests > 0:
+        # added last to be the outermost middleware, so shed requests cost nothing downstream
+        asgi_app.add_middleware(ConcurrencyLimitMiddleware, max_concurrent_requests=settings.max_concurrent_requests)
 
 
 def init_openapi(asgi_app: FastAPI) -> None:
@@ -151,10 +211,14 @@ def init_api() -> FastAPI:
     """Create & initialize our app."""
     asgi_app = FastAPI(lifespan=init_lifespan)
 
-    init_routes(asgi_app)
-    init_exception_handlers(asgi_app)
-    init_middleware(asgi_app)
-    init_openapi(asgi_app)
+    with profiling.profile_step("init_routes"):
+        init_routes(asgi_app)
+    with profiling.profile_step("init_exception_handlers"):
+        init_exception_handlers(asgi_app)
+    with profiling.profile_step("init_middleware"):
+        init_middleware(asgi_app)
+    with profiling.profile_step("init_openapi"):
+        init_openapi(asgi_app)
 
     return asgi_app
 
@@ -162,9 +226,7 @@ def init_api() -> FastAPI:
 asgi_app = init_api()
 
 
-def main():
-    uvicorn.run("otoge_service.entrypoint:asgi_app", port=settings.bind_port, host=settings.bind_host)
-
-
 if __name__ == "__main__":
+    from otoge_service.cli import main
+
     main()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import math
+from dataclasses import dataclass, replace
 from http import HTTPStatus
 from typing import ClassVar
 
@@ -11,6 +12,7 @@ from fastapi.responses import JSONResponse
 class LeporidException(RuntimeError):
     message: str
     http_status: HTTPStatus = HTTPStatus.INTERNAL_SERVER_ERROR
+    retry_after: int | None = None
 
     NOT_FOUND: ClassVar["LeporidException"]
     ALREADY_EXISTS: ClassVar["LeporidException"]
@@ -19,11 +21,16 @@ class LeporidException(RuntimeError):
     EXPIRED_CREDENTIALS: ClassVar["LeporidException"]
     FORBIDDEN: ClassVar["LeporidException"]
     BAD_REQUEST: ClassVar["LeporidException"]
+    TOO_MANY_REQUESTS: ClassVar["LeporidException"]
     INTERNAL_SERVER_ERROR: ClassVar["LeporidException"]
+    SERVICE_UNAVAILABLE: ClassVar["LeporidException"]
 
     def msg(self, message: str) -> "LeporidException":
         return LeporidException(http_status=self.http_status, message=message)
 
+    def after(self, seconds: float) -> "LeporidException":
+        return replace(self, retry_after=max(1, math.ceil(seconds)))
+
     def as_response(self) -> JSONResponse:
         return JSONResponse(
             {
@@ -32,6 +39,7 @@ class LeporidException(RuntimeError):
                 "data": None,
             },
             status_code=self.http_status,
+            headers={"Retry-After": str(self.retry_after)} if self.retry_after is not None else None,
         )
 
 
@@ -42,4 +50,6 @@ LeporidException.VALIDATION_ERROR = LeporidException("验证错误", http_status
 LeporidException.EXPIRED_CREDENTIALS = LeporidException("凭据已过期", http_status=HTTPStatus.UNAUTHORIZED)
 LeporidException.FORBIDDEN = LeporidException("没有权限执行该操作", http_status=HTTPStatus.FORBIDDEN)
 LeporidException.BAD_REQUEST = LeporidException("错误的请求", http_status=HTTPStatus.BAD_REQUEST)
+LeporidException.TOO_MANY_REQUESTS = LeporidException("请求过于频繁", http_status=HTTPStatus.TOO_MANY_REQUESTS)
 LeporidException.INTERNAL_SERVER_ERROR = LeporidException("内部错误", http_status=HTTPStatus.INTERNAL_SERVER_ERROR)
+LeporidException.SERVICE_UNAVAILABLE = LeporidException("服务繁忙", http_status=HTTPStatus.SERVICE_UNAVAILABLE)
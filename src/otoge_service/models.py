@@ -4,7 +4,7 @@ from typing import Self
 
 from maimai_py import Score as MpyScore
 from maimai_py.models import FCType, FSType, LevelIndex, RateType, SongType
-from sqlmodel import Field, SQLModel
+from sqlmodel import Field, Index, SQLModel, UniqueConstraint
 
 
 class Developer(SQLModel, table=True):
@@ -15,13 +15,38 @@ class Developer(SQLModel, table=True):
     token: str = Field(unique=True, index=True)
     description: str | None = Field(default=None)
     enabled: bool = Field(default=True)
+    rate_limit_capacity: int | None = Field(default=None)
+    rate_limit_refill_rate: float | None = Field(default=None)
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow, index=True, sa_column_kwargs={"onupdate": datetime.utcnow})
+
+
+class DeveloperUsage(SQLModel, table=True):
+    __tablename__ = "tbl_developer_usages"  # type: ignore
+    __table_args__ = (UniqueConstraint("token", "route", "bucket"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    token: str = Field(index=True)
+    route: str = Field(description="路由")
+    bucket: datetime = Field(index=True, description="统计时段起始时间")
+    requests: int = Field(default=0, description="请求次数")
+    upstream_calls: int = Field(default=0, description="上游调用次数")
+
+
+class AssetVersion(SQLModel, table=True):
+    __tablename__ = "tbl_asset_versions"  # type: ignore
+
+    name: str = Field(primary_key=True, description="资源名")
+    version: int = Field(default=0, description="资源版本")
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 
 # Maimai Assets
 
 class MaimaiScore(SQLModel, table=True):
     __tablename__ = "tbl_maimai_scores"  # type: ignore
+    # workers and `reshard` may insert the same chart of a player concurrently, the loser merges on retry
+    __table_args__ = (Index("uq_tbl_maimai_scores_chart", "uuid", "song_id", "type", "level_index", unique=True),)
 
     id: int | None = Field(default=None, primary_key=True)
     song_id: int = Field(index=True)
@@ -105,6 +130,22 @@ class MaimaiScore(SQLModel, table=True):
                 self.updated_at = datetime.utcnow()
         return self
 
+
+class UsagiCardSync(SQLModel, table=True):
+    __tablename__ = "tbl_usagicard_syncs"  # type: ignore
+
+    id: int | None = Field(default=None, primary_key=True)
+    uuid: str = Field(unique=True, index=True)
+    source: str = Field(description="上游数据源")
+    identifier: str = Field(description="上游玩家标识 (JSON)")
+    enabled: bool = Field(default=True)
+    last_error: str | None = Field(default=None)
+    last_synced_at: datetime | None = Field(default=None)
+    last_active_at: datetime = Field(default_factory=datetime.utcnow)
+    next_sync_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+
 class MaimaiCharacter(SQLModel, table=True):
     __tablename__ = "tbl_maimai_characters"  # type: ignore
 
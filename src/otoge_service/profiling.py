@@ -0,0 +1,76 @@
+import sys
+import time
+from contextlib import contextmanager
+from importlib.abc import Loader, MetaPathFinder
+
+from otoge_service.loggings import Ansi, log, magnitude_fmt_time
+
+enabled = False
+started_at = 0
+import_times: dict[str, int] = {}  # module -> import time in nanoseconds, including its own imports
+step_times: dict[str, int] = {}  # init step -> duration in nanoseconds
+
+
+class _ProfiledLoader(Loader):
+    """Time the execution of a module, whichever way it is imported (`from pkg import submodule` included)."""
+
+    def __init__(self, loader: Loader, name: str) -> None:
+        self.loader = loader
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        begin = time.perf_counter_ns()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            import_times.setdefault(self.name, time.perf_counter_ns() - begin)
+
+
+class _ProfilingFinder(MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            if (spec := finder.find_spec(fullname, path, target)) is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _ProfiledLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+def install() -> None:
+    """Start recording import and init step times, must run before the modules of interest are imported."""
+    global enabled, started_at
+    if not enabled:
+        enabled, started_at = True, time.perf_counter_ns()
+        sys.meta_path.insert(0, _ProfilingFinder())
+
+
+@contextmanager
+def profile_step(name: str):
+    if not enabled:
+        yield
+        return
+    begin = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        step_times[name] = time.perf_counter_ns() - begin
+
+
+def report(top: int = 20) -> int:
+    """Log the slowest imports and all init steps, returns the nanoseconds elapsed since `install`."""
+    elapsed = time.perf_counter_ns() - started_at
+    log(f"Startup took {magnitude_fmt_time(elapsed)}, slowest imports:", Ansi.LCYAN)
+    for name, duration in sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        log(f"  {magnitude_fmt_time(duration):>14}  {name}")
+    log("Init steps:", Ansi.LCYAN)
+    for name, duration in step_times.items():
+        log(f"  {magnitude_fmt_time(duration):>14}  {name}")
+    return elapsed
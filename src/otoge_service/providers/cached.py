@@ -0,0 +1,204 @@
+import asyncio
+import time
+import typing
+from collections import OrderedDict, defaultdict
+from dataclasses import astuple, fields
+from functools import partial
+
+from maimai_py import ArcadeProvider, DivingFishProvider, LXNSProvider, MaimaiClient, PlayerIdentifier
+from maimai_py.models import Score as MpyScore
+
+from otoge_service.loggings import Ansi, log
+from otoge_service.settings import get_settings
+
+T = typing.TypeVar("T")
+settings = get_settings()
+
+
+class UpstreamCache:
+    """Stale-while-revalidate cache of upstream player data, keyed by (provider, identifier, route).
+
+    Entries younger than the route TTL are served directly. Entries older than that but younger
+    than TTL + `stale` are served while a background refresh runs, older ones are fetched inline.
+    Entries are tagged with each field of their identifier, and identifier fields are aliased to the
+    tag of the player they resolved to (e.g. qq to username), so an update invalidates the reads of
+    the player made through any identifier once the player of both is known.
+    """
+
+    def __init__(self, ttls: dict[str, float], stale: float, size: int) -> None:
+        self.ttls = ttls
+        self.stale = stale
+        self.size = size
+        self._entries: OrderedDict[str, tuple[float, typing.Any, list[str]]] = OrderedDict()
+        self._tags: defaultdict[str, set[str]] = defaultdict(set)
+        self._refreshing: dict[str, asyncio.Task] = {}
+        self._aliases: OrderedDict[str, str] = OrderedDict()  # identifier tag -> player tag
+        self._aliased: defaultdict[str, set[str]] = defaultdict(set)  # player tag -> identifier tags
+
+    @staticmethod
+    def _tags_of(provider: str, identifier: PlayerIdentifier) -> list[str]:
+        return [f"{provider}:{f.name}={value}" for f, value in zip(fields(identifier), astuple(identifier)) if value is not None]
+
+    def _set(self, key: str, tags: list[str], value: typing.Any) -> None:
+        self._entries[key] = (time.monotonic(), value, tags)
+        self._entries.move_to_end(key)
+        for tag in tags:
+            self._tags[tag].add(key)
+        while len(self._entries) > self.size:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str) -> None:
+        if (entry := self._entries.pop(key, None)) is not None:
+            for tag in entry[2]:
+                if (keys := self._tags.get(tag)) is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+        if task := self._refreshing.pop(key, None):
+            task.cancel()
+
+    async def _fetch(self, key: str, tags: list[str], fetch: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        value = await fetch()
+        self._set(key, tags, value)
+        return value
+
+    def _refresh(self, key: str, tags: list[str], fetch: typing.Callable[[], typing.Awaitable[T]]) -> None:
+        if key in self._refreshing:
+            return
+
+        def _done(task: asyncio.Task) -> None:
+            self._refreshing.pop(key, None)
+            if not task.cancelled() and (e := task.exception()) is not None:
+                log(f"Failed to refresh upstream cache {key.split(':', 2)[:2]}: {e!r}", Ansi.LYELLOW)
+
+        task = asyncio.create_task(self._fetch(key, tags, fetch))
+        task.add_done_callback(_done)
+        self._refreshing[key] = task
+
+    async def get(self, provider: str, route: str, identifier: PlayerIdentifier, fetch: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        if (ttl := self.ttls.get(route)) is None or not isinstance(identifier.credentials, (str, type(None))):
+            return await fetch()
+        key = f"{provider}:{route}:{astuple(identifier)!r}"
+        tags = self._tags_of(provider, identifier)
+        if (entry := self._entries.get(key)) is not None:
+            self._entries.move_to_end(key)
+            fetched_at, value, _ = entry
+            age = time.monotonic() - fetched_at
+            if age < ttl:
+                return value
+            if age < ttl + self.stale:
+                self._refresh(key, tags, fetch)
+                return value
+        return await self._fetch(key, tags, fetch)
+
+    def learn(self, provider: str, identifier: PlayerIdentifier, player_tag: str) -> None:
+        """Alias the identifier fields to the tag of the player they resolved to."""
+        for tag in self._tags_of(provider, identifier):
+            if tag == player_tag:
+                continue
+            if (previous := self._aliases.pop(tag, None)) is not None:
+                self._aliased[previous].discard(tag)
+            self._aliases[tag] = player_tag
+            self._aliased[player_tag].add(tag)
+        while len(self._aliases) > self.size:
+            tag, previous = self._aliases.popitem(last=False)
+            if (tags := self._aliased.get(previous)) is not None:
+                tags.discard(tag)
+                if not tags:
+                    del self._aliased[previous]
+
+    def resolve(self, provider: str, identifier: PlayerIdentifier) -> str | None:
+        return next((self._aliases[tag] for tag in self._tags_of(provider, identifier) if tag in self._aliases), None)
+
+    def invalidate(self, provider: str, identifier: PlayerIdentifier, player_tag: str | None = None) -> None:
+        """Drop the entries of the player, read through the identifier or any identifier aliased to the same player."""
+        tags = set(self._tags_of(provider, identifier))
+        if player_tag is not None:
+            tags.add(player_tag)
+        tags |= {self._aliases[tag] for tag in tags if tag in self._aliases}
+        tags |= {alias for tag in tags for alias in self._aliased.get(tag, ())}
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+
+
+upstream_cache = UpstreamCache(settings.upstream_cache_ttls, settings.upstream_cache_stale, settings.upstream_cache_size)
+
+
+class CachedProviderMixin:
+    """Serve the player routes of an upstream provider through `upstream_cache`."""
+
+    cache_label: typing.ClassVar[str]
+    # identifier field naming a player and the player attribute holding it, None if players can't be resolved
+    cache_player_field: typing.ClassVar[tuple[str, str] | None] = None
+
+    def _player_tag(self, player: typing.Any) -> str | None:
+        if self.cache_player_field is None or (value := getattr(player, self.cache_player_field[1], None)) is None:
+            return None
+        return f"{self.cache_label}:{self.cache_player_field[0]}={value}"
+
+    async def get_player(self, identifier: PlayerIdentifier, client: MaimaiClient):
+        fetch = partial(super().get_player, identifier, client)  # type: ignore
+        player = await upstream_cache.get(self.cache_label, "players", identifier, fetch)
+        if (player_tag := self._player_tag(player)) is not None:
+            upstream_cache.learn(self.cache_label, identifier, player_tag)
+        return player
+
+    async def get_scores_all(self, identifier: PlayerIdentifier, client: MaimaiClient) -> list[MpyScore]:
+        fetch = partial(super().get_scores_all, identifier, client)  # type: ignore
+        return list(await upstream_cache.get(self.cache_label, "scores", identifier, fetch))
+
+    async def get_scores_best(self, identifier: PlayerIdentifier, client: MaimaiClient) -> list[MpyScore]:
+        fetch = partial(super().get_scores_best, identifier, client)  # type: ignore
+        return list(await upstream_cache.get(self.cache_label, "bests", identifier, fetch))
+
+    def _can_resolve(self, identifier: PlayerIdentifier) -> bool:
+        return self.cache_player_field is not None
+
+    async def update_scores(self, identifier: PlayerIdentifier, scores: typing.Iterable[MpyScore], client: MaimaiClient) -> None:
+        await super().update_scores(identifier, scores, client)  # type: ignore
+        # only reached if the update succeeded, the updated player is resolved unless the identifier names it already
+        if (
+            not self._can_resolve(identifier)
+            or getattr(identifier, self.cache_player_field[0]) is not None  # type: ignore
+            or upstream_cache.resolve(self.cache_label, identifier) is not None
+        ):
+            return upstream_cache.invalidate(self.cache_label, identifier)
+        try:
+            player_tag = self._player_tag(await super().get_player(identifier, client))  # type: ignore
+        except Exception:
+            player_tag = None
+        if player_tag is not None:
+            upstream_cache.learn(self.cache_label, identifier, player_tag)
+        upstream_cache.invalidate(self.cache_label, identifier, player_tag)
+
+
+class CachedDivingFishProvider(CachedProviderMixin, DivingFishProvider):
+    cache_label = "divingfish"
+    cache_player_field = ("username", "name")
+
+    def _can_resolve(self, identifier: PlayerIdentifier) -> bool:
+        # get_player can't take an import token, its player is learned from the records read with it instead
+        return identifier.qq is not None or identifier.username is not None
+
+    async def _get_scores_by_token(self, identifier: PlayerIdentifier, client: MaimaiClient) -> list[MpyScore]:
+        resp = await client._client.get(self.base_url + "player/records", headers={"Import-Token": identifier.credentials})
+        resp_json = self._check_response_player(resp)
+        if username := resp_json.get("username"):
+            upstream_cache.learn(self.cache_label, identifier, f"{self.cache_label}:username={username}")
+        return [s for score in resp_json["records"] if (s := DivingFishProvider._deser_score(score))]
+
+    async def get_scores_all(self, identifier: PlayerIdentifier, client: MaimaiClient) -> list[MpyScore]:
+        if isinstance(identifier.credentials, str) and identifier.username is None:
+            fetch = partial(self._get_scores_by_token, identifier, client)
+            return list(await upstream_cache.get(self.cache_label, "scores", identifier, fetch))
+        return await super().get_scores_all(identifier, client)
+
+
+class CachedLXNSProvider(CachedProviderMixin, LXNSProvider):
+    cache_label = "lxns"
+    cache_player_field = ("friend_code", "friend_code")
+
+
+class CachedArcadeProvider(CachedProviderMixin, ArcadeProvider):
+    cache_label = "arcade"
@@ -2,6 +2,7 @@ import asyncio
 import re
 import typing
 from collections import defaultdict
+from datetime import datetime
 from typing import TypeVar
 
 from maimai_py import (
@@ -12,18 +13,158 @@ from maimai_py import (
     Song,
 )
 from maimai_py.models import Score as MpyScore
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import col, select
 
+from otoge_service import traces
 from otoge_service.exceptions import LeporidException
+from otoge_service.loggings import Ansi, log
 from otoge_service.models import MaimaiScore
-from otoge_service.sessions import async_session_ctx
+from otoge_service.sessions import async_session_ctx, is_resharding
+from otoge_service.settings import get_settings
 
 T = TypeVar("T")
+settings = get_settings()
 score_update_lock = defaultdict(asyncio.Lock)
+SCORE_WRITE_ATTEMPTS = 3
+player_activity: dict[str, datetime] = {}  # uuid -> last read, drained by the sync scheduler
 
 uuid_pattern = re.compile(r"^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$", re.IGNORECASE)
 
 
+def _score_key(song_id: int, type: typing.Any, level_index: typing.Any) -> str:
+    return f"{song_id} {type} {level_index}"
+
+
+def merge_scores(scores: typing.Iterable[MaimaiScore], others: typing.Iterable[MaimaiScore]) -> list[MaimaiScore]:
+    """Merge `others` into `scores`, which may be mutated, while `others` (e.g. buffered scores) are left untouched."""
+    merged = {_score_key(s.song_id, s.type, s.level_index): s for s in scores}
+    for other in others:
+        score_key = _score_key(other.song_id, other.type, other.level_index)
+        if score_key in merged:
+            merged[score_key].merge_mpy(other.as_mpy())
+        else:
+            merged[score_key] = MaimaiScore.model_validate(other.model_dump())
+    return list(merged.values())
+
+
+async def read_scores(uuid: str, *clauses: typing.Any) -> list[MaimaiScore]:
+    """Read the stored scores of the player from its shard."""
+    stmt = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid, *clauses)
+    async with async_session_ctx(uuid) as session:
+        scores = list(await session.exec(stmt))
+    if is_resharding(uuid):
+        # the player may not have been moved yet, so its scores left on the previous shard are merged in
+        async with async_session_ctx(uuid, previous=True) as session:
+            scores = merge_scores(scores, await session.exec(stmt))
+    return scores
+
+
+async def write_scores(uuid: str, scores: typing.Iterable[MpyScore]) -> None:
+    """Merge the scores into the stored scores of the player in a single transaction."""
+    scores = list(scores)
+    for attempt in range(SCORE_WRITE_ATTEMPTS):
+        try:
+            async with async_session_ctx(uuid) as session, traces.traced_lock(score_update_lock[uuid], "score_update_lock"):
+                stmt = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid).with_for_update()
+                old_scores = {_score_key(s.song_id, s.type, s.level_index): s for s in await session.exec(stmt)}
+                for new_score in scores:
+                    score_key = _score_key(new_score.id, new_score.type, new_score.level_index)
+                    if score_key in old_scores:
+                        # score already exists in the database, merge the score
+                        old_scores[score_key].merge_mpy(new_score)
+                    else:
+                        # score does not exist in the database, add the score (later duplicates in the batch merge into it)
+                        old_scores[score_key] = MaimaiScore.from_mpy(new_score, uuid)
+                        session.add(old_scores[score_key])
+                await session.commit()
+            return
+        except IntegrityError:
+            # the same chart was inserted outside of this worker's lock (e.g. by `reshard`), merge into it next time
+            if attempt == SCORE_WRITE_ATTEMPTS - 1:
+                raise
+
+
+class ScoreWriteBuffer:
+    """Coalesce score updates per UUID in memory and write them behind in one transaction.
+
+    Updates for the same UUID arriving within `delay` seconds are merged with `MaimaiScore.merge_mpy`,
+    so a burst of updates costs a single transaction. Pending scores are visible to the reads of this
+    worker through `overlay`, and `flush_all` must be awaited on shutdown to persist what is left.
+    """
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self._pending: dict[str, dict[str, MaimaiScore]] = {}
+        self._flushing: dict[str, dict[str, MaimaiScore]] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+
+    def add(self, uuid: str, scores: typing.Iterable[MpyScore]) -> None:
+        pending = self._pending.setdefault(uuid, {})
+        for new_score in scores:
+            score_key = _score_key(new_score.id, new_score.type, new_score.level_index)
+            if score_key in pending:
+                pending[score_key].merge_mpy(new_score)
+            else:
+                pending[score_key] = MaimaiScore.from_mpy(new_score, uuid)
+        if uuid not in self._timers:
+            self._timers[uuid] = asyncio.create_task(self._flush_later(uuid))
+
+    def overlay(self, uuid: str, scores: typing.Iterable[MaimaiScore]) -> list[MaimaiScore]:
+        """Merge the scores not yet committed by this worker into the scores read from the database."""
+        for batch in (self._flushing.get(uuid), self._pending.get(uuid)):
+            scores = merge_scores(scores, (batch or {}).values())
+        return list(scores)
+
+    async def _flush_later(self, uuid: str) -> None:
+        try:
+            while uuid in self._pending:
+                await asyncio.sleep(self.delay)
+                await self.flush(uuid)
+        finally:
+            self._timers.pop(uuid, None)
+
+    def _restore(self, uuid: str, batch: dict[str, MaimaiScore]) -> None:
+        # the restored batch is older than anything buffered meanwhile, so newer scores are merged into it
+        for score_key, buffered in self._pending.pop(uuid, {}).items():
+            if score_key in batch:
+                batch[score_key].merge_mpy(buffered.as_mpy())
+            else:
+                batch[score_key] = buffered
+        self._pending[uuid] = batch
+
+    async def flush(self, uuid: str) -> None:
+        if not (batch := self._pending.pop(uuid, None)):
+            return
+        self._flushing[uuid] = batch
+        try:
+            await write_scores(uuid, [score.as_mpy() for score in batch.values()])
+        except BaseException as e:
+            self._restore(uuid, batch)
+            if not isinstance(e, Exception):
+                raise
+            log(f"Failed to flush {len(batch)} buffered scores of {uuid}, retrying: {e!r}", Ansi.LRED)
+        finally:
+            self._flushing.pop(uuid, None)
+
+    async def flush_all(self) -> None:
+        timers = list(self._timers.values())
+        for timer in timers:
+            timer.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        batches = [(uuid, self._pending.pop(uuid)) for uuid in list(self._pending)]
+        results = await asyncio.gather(
+            *(write_scores(uuid, [score.as_mpy() for score in batch.values()]) for uuid, batch in batches),
+            return_exceptions=True,
+        )
+        for (uuid, batch), result in zip(batches, results):
+            if isinstance(result, BaseException):
+                log(f"Dropped {len(batch)} buffered scores of {uuid} on shutdown: {result!r}", Ansi.LRED)
+
+
+score_write_buffer = ScoreWriteBuffer(settings.usagicard_write_behind_delay) if settings.usagicard_write_behind else None
+
+
 class UsagiCardProvider(IScoreProvider, IScoreUpdateProvider):
     def _check_uuid(self, identifier: PlayerIdentifier) -> str:
         assert isinstance(identifier.credentials, str), "Identifier credentials must be a string"
@@ -31,29 +172,29 @@ class UsagiCardProvider(IScoreProvider, IScoreUpdateProvider):
             raise LeporidException.INVALID_CREDENTIALS.msg("无效的 UUID 格式")
         return identifier.credentials
 
+    def _record_activity(self, uuid: str) -> None:
+        if settings.enable_usagicard_sync:
+            player_activity[uuid] = datetime.utcnow()
+
     async def get_scores_all(self, identifier: PlayerIdentifier, client: MaimaiClient) -> list[MpyScore]:
         uuid_ident = self._check_uuid(identifier)
-        async with async_session_ctx() as session:
-            stmt = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid_ident)
-            return [score.as_mpy() for score in await session.exec(stmt)]
+        self._record_activity(uuid_ident)
+        scores = await read_scores(uuid_ident)
+        if score_write_buffer is not None:
+            scores = score_write_buffer.overlay(uuid_ident, scores)
+        return [score.as_mpy() for score in scores]
 
     async def get_scores_one(self, identifier: PlayerIdentifier, song: Song, client: MaimaiClient) -> list[MpyScore]:
         uuid_ident = self._check_uuid(identifier)
-        async with async_session_ctx() as session:
-            stmt = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid_ident, col(MaimaiScore.song_id) % 10000 == song.id)
-            return [score.as_mpy() for score in await session.exec(stmt)]
+        self._record_activity(uuid_ident)
+        scores = await read_scores(uuid_ident, col(MaimaiScore.song_id) % 10000 == song.id)
+        if score_write_buffer is not None:
+            scores = [s for s in score_write_buffer.overlay(uuid_ident, scores) if s.song_id % 10000 == song.id]
+        return [score.as_mpy() for score in scores]
 
     async def update_scores(self, identifier: PlayerIdentifier, scores: typing.Iterable[MpyScore], client: MaimaiClient) -> None:
         uuid_ident = self._check_uuid(identifier)
-        async with async_session_ctx() as session, score_update_lock[identifier.credentials]:
-            stmt = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid_ident).with_for_update()
-            old_scores = {f"{s.song_id} {s.type} {s.level_index}": s for s in await session.exec(stmt)}
-            for new_score in scores:
-                score_key = f"{new_score.id} {new_score.type} {new_score.level_index}"
-                if score_key in old_scores:
-                    # score already exists in the database, merge the score
-                    old_scores[score_key].merge_mpy(new_score)
-                else:
-                    # score does not exist in the database, add the score
-                    session.add(MaimaiScore.from_mpy(new_score, uuid_ident))
-            await session.commit()
+        if score_write_buffer is not None:
+            score_write_buffer.add(uuid_ident, scores)
+            return
+        await write_scores(uuid_ident, scores)
@@ -0,0 +1,148 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from otoge_service import sessions
+from otoge_service.exceptions import LeporidException
+from otoge_service.settings import get_settings
+
+if TYPE_CHECKING:
+    from redis.commands.core import AsyncScript
+
+settings = get_settings()
+
+REDIS_TIMEOUT = 0.1
+LOCAL_BUCKETS_SIZE = 65536
+
+# KEYS[1]: bucket key, ARGV[1]: capacity, ARGV[2]: refill rate (tokens per second)
+# returns the seconds to wait before the next token is available, 0 if a token was taken
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+# KEYS[1]: slots key, ARGV[1]: limit, ARGV[2]: lease (seconds), ARGV[3]: slot id
+# returns 1 if the slot was acquired, 0 if `limit` unexpired slots are held already
+SLOT_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])) + 1)
+return 1
+"""
+
+
+@dataclass
+class TokenBucket:
+    tokens: float
+    updated_at: float
+
+    def take(self, capacity: int, refill_rate: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + max(0.0, now - self.updated_at) * refill_rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / refill_rate
+
+
+local_buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+local_slots: dict[str, dict[str, float]] = {}  # slots key -> slot id -> expiry
+
+
+@lru_cache(maxsize=1)
+def get_token_bucket_script() -> "AsyncScript | None":
+    redis_client = sessions.get_redis_client()
+    return redis_client.register_script(TOKEN_BUCKET_SCRIPT) if redis_client is not None else None  # type: ignore
+
+
+@lru_cache(maxsize=1)
+def get_slot_script() -> "AsyncScript | None":
+    redis_client = sessions.get_redis_client()
+    return redis_client.register_script(SLOT_SCRIPT) if redis_client is not None else None  # type: ignore
+
+
+def _take_local(key: str, capacity: int, refill_rate: float) -> float:
+    if (bucket := local_buckets.get(key)) is None:
+        bucket = local_buckets[key] = TokenBucket(tokens=capacity, updated_at=time.monotonic())
+        if len(local_buckets) > LOCAL_BUCKETS_SIZE:
+            local_buckets.popitem(last=False)
+    else:
+        local_buckets.move_to_end(key)
+    return bucket.take(capacity, refill_rate)
+
+
+async def take(key: str, capacity: int, refill_rate: float) -> float:
+    """Take a token from the bucket of the key, returns the seconds to wait for one if it is empty (0 if taken)."""
+    if (token_bucket_script := get_token_bucket_script()) is not None:
+        try:
+            wait = await asyncio.wait_for(token_bucket_script(keys=[f"ratelimit:{key}"], args=[capacity, refill_rate]), REDIS_TIMEOUT)
+            return float(wait)
+        except Exception:
+            pass  # redis is unavailable or too slow, fall back to the in-process bucket
+    return _take_local(key, capacity, refill_rate)
+
+
+async def hit(key: str, capacity: int | None = None, refill_rate: float | None = None) -> None:
+    """Take a token from the bucket of the key, raise `TOO_MANY_REQUESTS` with Retry-After if it is empty."""
+    capacity = capacity or settings.rate_limit_capacity
+    refill_rate = refill_rate or settings.rate_limit_refill_rate
+    if (wait := await take(key, capacity, refill_rate)) > 0:
+        raise LeporidException.TOO_MANY_REQUESTS.msg(f"请求过于频繁，请在 {wait:.1f} 秒后重试").after(wait)
+
+
+def _acquire_local(key: str, limit: int, lease: float, slot: str) -> bool:
+    now = time.monotonic()
+    slots = local_slots.setdefault(key, {})
+    for expired in [held for held, expires_at in slots.items() if expires_at <= now]:
+        del slots[expired]
+    if len(slots) >= limit:
+        return False
+    slots[slot] = now + lease
+    return True
+
+
+async def acquire(key: str, limit: int, lease: float) -> str | None:
+    """Acquire one of `limit` slots of the key for up to `lease` seconds, returns the slot to release or None if all are held."""
+    slot = secrets.token_hex(8)
+    if (slot_script := get_slot_script()) is not None:
+        try:
+            acquired = await asyncio.wait_for(slot_script(keys=[f"slots:{key}"], args=[limit, lease, slot]), REDIS_TIMEOUT)
+            return slot if int(acquired) else None
+        except Exception:
+            pass  # redis is unavailable or too slow, fall back to the in-process slots
+    return slot if _acquire_local(key, limit, lease, slot) else None
+
+
+async def release(key: str, slot: str) -> None:
+    """Release a slot acquired by `acquire`, a slot that can't be released is freed once its lease expires."""
+    local_slots.get(key, {}).pop(slot, None)
+    if (redis_client := sessions.get_redis_client()) is not None:
+        try:
+            await asyncio.wait_for(redis_client.zrem(f"slots:{key}", slot), REDIS_TIMEOUT)
+        except Exception:
+            pass
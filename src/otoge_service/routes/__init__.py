@@ -1,13 +1,26 @@
 from fastapi import APIRouter
 
 from otoge_service import sessions
-from otoge_service.routes import chunithm, developers, maimai, ongeki
+from otoge_service.routes import developers, maimai
 
 router = APIRouter()
 settings = sessions.get_settings()
 
+# asset subsystems are only imported when enabled, so disabled ones cost nothing at startup
 router.include_router(maimai.router, prefix="/maimai", tags=["maimai"], dependencies=developers.dependencies)
-router.include_router(ongeki.router, prefix="/ongeki", tags=["ongeki"], dependencies=developers.dependencies)
-router.include_router(chunithm.router, prefix="/chunithm", tags=["chunithm"], dependencies=developers.dependencies)
+if settings.enable_ongeki_assets:
+    from otoge_service.routes import ongeki
+
+    router.include_router(ongeki.router, prefix="/ongeki", tags=["ongeki"], dependencies=developers.dependencies)
+if settings.enable_chunithm_assets:
+    from otoge_service.routes import chunithm
+
+    router.include_router(chunithm.router, prefix="/chunithm", tags=["chunithm"], dependencies=developers.dependencies)
+if settings.enable_flight_recorder and settings.flight_recorder_admin_token:
+    from otoge_service.routes import admin
+
+    router.include_router(admin.router, prefix="/admin", tags=["admin"])
 if settings.enable_developer_apply and settings.enable_developer_check:
     router.include_router(developers.router, prefix="/developers", tags=["developers"])
+if settings.enable_developer_check:
+    router.include_router(developers.usages_router, prefix="/developers", tags=["developers"])
@@ -0,0 +1,30 @@
+import secrets
+
+from fastapi import APIRouter, Depends, Security
+from fastapi.security import APIKeyHeader
+
+from otoge_service import sessions, traces
+from otoge_service.exceptions import LeporidException
+
+settings = sessions.get_settings()
+admin_key_header = APIKeyHeader(name="x-admin-token", auto_error=False)
+
+
+async def require_admin_token(api_key: str | None = Security(admin_key_header)):
+    if api_key is None or not secrets.compare_digest(api_key, settings.flight_recorder_admin_token or ""):
+        raise LeporidException.FORBIDDEN.msg("需要提供有效的管理员令牌")
+
+
+router = APIRouter(dependencies=[Depends(require_admin_token)])
+
+
+@router.get("/traces")
+async def get_traces(limit: int = 50, path: str | None = None):
+    """List the recorded slow requests of this worker, newest first."""
+    recorded = [trace for trace in reversed(traces.recorded_traces) if path is None or trace["path"].startswith(path)]
+    return recorded[:limit]
+
+
+@router.delete("/traces")
+async def clear_traces():
+    traces.recorded_traces.clear()
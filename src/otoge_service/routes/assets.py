@@ -0,0 +1,19 @@
+from fastapi import HTTPException, Request, Response
+from sqlmodel import select
+
+from otoge_service.models import AssetVersion
+from otoge_service.sessions import async_session_ctx
+
+
+def asset_version(name: str):
+    """Tag the response with the version of the asset table bumped by `import-assets`, and answer 304 if it is unchanged."""
+
+    async def dependency(request: Request, response: Response) -> None:
+        async with async_session_ctx() as session:
+            version = (await session.exec(select(AssetVersion.version).where(AssetVersion.name == name))).first() or 0
+        etag = f'W/"{name}-{version}"'
+        if etag in request.headers.get("if-none-match", ""):
+            raise HTTPException(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+    return dependency
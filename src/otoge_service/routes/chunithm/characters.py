@@ -1,13 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import col, select
 
 from otoge_service.models import ChunithmCharacter
+from otoge_service.routes.assets import asset_version
 from otoge_service.sessions import async_session_ctx
 
 router = APIRouter()
 
 
-@router.get("/characters", response_model=list[ChunithmCharacter])
+@router.get("/characters", response_model=list[ChunithmCharacter], dependencies=[Depends(asset_version("chunithm-characters"))])
 async def get_chunithm_characters(
     id: int | None = None,
     name: str | None = None,
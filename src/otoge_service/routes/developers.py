@@ -1,46 +1,72 @@
 import secrets
+from datetime import datetime
 
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Depends, Request, Security
 from fastapi.security import APIKeyHeader
-from sqlmodel import select
+from sqlmodel import col, select
 
-from otoge_service import sessions
+from otoge_service import ratelimits, sessions, usages
 from otoge_service.exceptions import LeporidException
-from otoge_service.models import Developer
+from otoge_service.models import Developer, DeveloperUsage
 from otoge_service.sessions import async_session_ctx
 
 router = APIRouter()
+usages_router = APIRouter()  # mounted whenever developers are checked, even with self-service apply disabled
 settings = sessions.get_settings()
 api_key_header = APIKeyHeader(name="x-developer-token", auto_error=False)
 
 
-async def require_developer_token(api_key: str | None = Security(api_key_header)):
+async def require_developer_token(request: Request, api_key: str | None = Security(api_key_header)):
     if api_key is not None:
-        if api_key in sessions.enabled_developer_tokens:
+        token_hash = sessions.hash_token(api_key)
+        if developer := sessions.enabled_developer_tokens.get(token_hash):
+            if settings.enable_rate_limit:
+                await ratelimits.hit(f"token:{token_hash}", developer.rate_limit_capacity, developer.rate_limit_refill_rate)
+            route = request.scope.get("route")
+            usages.record_request(token_hash, getattr(route, "path", request.url.path))
             return api_key
         raise LeporidException.INVALID_CREDENTIALS.msg("开发者令牌无效")
     raise LeporidException.INVALID_CREDENTIALS.msg("需要提供开发者令牌")
 
 
+async def require_client_rate_limit(request: Request):
+    client_host = request.client.host if request.client else "unknown"
+    await ratelimits.hit(f"ip:{client_host}")
+
+
 dependencies = []
 if settings.enable_developer_check:
     dependencies.append(Depends(require_developer_token))
+elif settings.enable_rate_limit:
+    dependencies.append(Depends(require_client_rate_limit))
 
 
 @router.post("", response_model=Developer)
 async def apply_developer(name: str, description: str | None = None):
     async with async_session_ctx() as session:
         token = secrets.token_hex(16)
-        developer = Developer(name=name, token=token, description=description, enabled=False)
+        developer = Developer(name=name, token=sessions.hash_token(token), description=description, enabled=False)
         session.add(developer)
         await session.commit()
-    return developer
+    # only the hash is stored, so the plain token is returned this once
+    return developer.model_copy(update={"token": token})
 
 
 @router.get("", response_model=Developer)
 async def get_developer(developer_token: str):
-    await sessions.init_developers()
     async with async_session_ctx() as session:
-        developer = (await session.exec(select(Developer).where(Developer.token == developer_token))).first()
-        return developer
+        clause = select(Developer).where(Developer.token == sessions.hash_token(developer_token))
+        if developer := (await session.exec(clause)).first():
+            return developer
     raise LeporidException.INVALID_CREDENTIALS.msg("开发者令牌无效")
+
+
+@usages_router.get("/usages", response_model=list[DeveloperUsage])
+async def get_developer_usages(developer_token: str, since: datetime | None = None, until: datetime | None = None):
+    async with async_session_ctx() as session:
+        clause = select(DeveloperUsage).where(DeveloperUsage.token == sessions.hash_token(developer_token))
+        if since is not None:
+            clause = clause.where(col(DeveloperUsage.bucket) >= since)
+        if until is not None:
+            clause = clause.where(col(DeveloperUsage.bucket) < until)
+        return (await session.exec(clause.order_by(col(DeveloperUsage.bucket)))).all()
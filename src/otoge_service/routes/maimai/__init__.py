@@ -1,28 +1,54 @@
 from fastapi import APIRouter
-from maimai_py import MaimaiRoutes, PlayerIdentifier
 
-from otoge_service.providers.usagicard import UsagiCardProvider
-from otoge_service.routes.maimai import chains, characters
-from otoge_service.sessions import maimai_client
+from otoge_service.sessions import get_maimai_client
 from otoge_service.settings import get_settings
 
 router = APIRouter()
 settings = get_settings()
+providers = set(settings.maimai_providers)
 
-routes = MaimaiRoutes(
-    maimai_client,
-    settings.lxns_developer_token,
-    settings.divingfish_developer_token,
-    settings.arcade_proxy,
-)
-
-if settings.enable_maimai_assets:
-    router.include_router(routes.get_router(routes._dep_hybrid, skip_base=False))
-    router.include_router(characters.router)  # add maimai characters route (next to the included base routes)
-router.include_router(chains.get_router(routes))  # add maimai update chain route
-router.include_router(routes.get_wechat_oauth_route())  # add wechat oauth route
-router.include_router(routes.get_router(routes._dep_divingfish, routes._dep_divingfish_player), prefix="/divingfish")
-router.include_router(routes.get_router(routes._dep_lxns, routes._dep_lxns_player), prefix="/lxns")
-router.include_router(routes.get_router(routes._dep_wechat, routes._dep_wechat_player), prefix="/wechat")
-router.include_router(routes.get_router(routes._dep_arcade, routes._dep_arcade_player), prefix="/arcade")
-router.include_router(routes.get_router(lambda: UsagiCardProvider(), lambda uuid: PlayerIdentifier(credentials=uuid)), prefix="/usagicard")
+# the routes object builds the maimai.py client, so it is left out when no maimai route is served
+if providers or settings.enable_maimai_assets:
+    from maimai_py import MaimaiRoutes, PlayerIdentifier
+
+    from otoge_service.routes.maimai import chains
+
+    routes = MaimaiRoutes(
+        get_maimai_client(),
+        settings.lxns_developer_token,
+        settings.divingfish_developer_token,
+        settings.arcade_proxy,
+    )
+    dep_divingfish, dep_lxns, dep_arcade = routes._dep_divingfish, routes._dep_lxns, routes._dep_arcade
+    if settings.enable_upstream_cache:
+        from otoge_service.providers import cached
+
+        dep_divingfish = lambda: cached.CachedDivingFishProvider(developer_token=settings.divingfish_developer_token)
+        dep_lxns = lambda: cached.CachedLXNSProvider(developer_token=settings.lxns_developer_token)
+        dep_arcade = lambda: cached.CachedArcadeProvider(http_proxy=settings.arcade_proxy)
+
+    if settings.enable_maimai_assets:
+        from otoge_service.routes.maimai import characters
+
+        router.include_router(routes.get_router(routes._dep_hybrid, skip_base=False))
+        router.include_router(characters.router)  # add maimai characters route (next to the included base routes)
+    if providers:
+        router.include_router(chains.get_router(routes, providers, dep_divingfish, dep_lxns))  # add maimai update chain route
+    if "wechat" in providers:
+        router.include_router(routes.get_wechat_oauth_route())  # add wechat oauth route
+    if "divingfish" in providers:
+        router.include_router(routes.get_router(dep_divingfish, routes._dep_divingfish_player), prefix="/divingfish")
+    if "lxns" in providers:
+        router.include_router(routes.get_router(dep_lxns, routes._dep_lxns_player), prefix="/lxns")
+    if "wechat" in providers:
+        router.include_router(routes.get_router(routes._dep_wechat, routes._dep_wechat_player), prefix="/wechat")
+    if "arcade" in providers:
+        router.include_router(routes.get_router(dep_arcade, routes._dep_arcade_player), prefix="/arcade")
+    if "usagicard" in providers:
+        from otoge_service.providers.usagicard import UsagiCardProvider
+
+        router.include_router(routes.get_router(lambda: UsagiCardProvider(), lambda uuid: PlayerIdentifier(credentials=uuid)), prefix="/usagicard")
+        if settings.enable_usagicard_sync:
+            from otoge_service.routes.maimai import syncs
+
+            router.include_router(syncs.router, prefix="/usagicard")
@@ -1,21 +1,27 @@
+from typing import Callable
+
 from maimai_py import MaimaiRoutes
 
-from otoge_service.providers.usagicard import UsagiCardProvider
 
+def get_router(routes: MaimaiRoutes, providers: set[str], dep_divingfish: Callable, dep_lxns: Callable):
+    # sources always fetch fresh scores, targets may be cached providers that invalidate the player once updated
+    source_deps = [
+        ("divingfish", routes._dep_divingfish),
+        ("lxns", routes._dep_lxns),
+        ("wechat", routes._dep_wechat),
+        ("arcade", routes._dep_arcade),
+    ]
+    target_deps = [
+        ("divingfish", dep_divingfish),
+        ("lxns", dep_lxns),
+    ]
+    if "usagicard" in providers:
+        from otoge_service.providers.usagicard import UsagiCardProvider
 
-def get_router(routes: MaimaiRoutes):
+        target_deps.append(("usagicard", lambda: UsagiCardProvider()))
     return routes.get_updates_chain_route(
-        source_deps=[
-            ("divingfish", routes._dep_divingfish),
-            ("lxns", routes._dep_lxns),
-            ("wechat", routes._dep_wechat),
-            ("arcade", routes._dep_arcade),
-        ],
-        target_deps=[
-            ("divingfish", routes._dep_divingfish),
-            ("lxns", routes._dep_lxns),
-            ("usagicard", lambda: UsagiCardProvider()),
-        ],
+        source_deps=[(label, dep) for label, dep in source_deps if label in providers],
+        target_deps=[(label, dep) for label, dep in target_deps if label in providers],
         source_mode="fallback",
         target_mode="parallel",
     )
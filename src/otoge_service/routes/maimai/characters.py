@@ -1,15 +1,16 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import col, select
 
 from otoge_service import sessions
 from otoge_service.models import MaimaiCharacter
+from otoge_service.routes.assets import asset_version
 from otoge_service.sessions import async_session_ctx
 
 router = APIRouter()
 settings = sessions.get_settings()
 
 
-@router.get("/characters", response_model=list[MaimaiCharacter])
+@router.get("/characters", response_model=list[MaimaiCharacter], dependencies=[Depends(asset_version("maimai-characters"))])
 async def get_maimai_characters(
     id: int | None = None,
     name: str | None = None,
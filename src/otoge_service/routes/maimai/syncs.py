@@ -0,0 +1,51 @@
+import json
+import random
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from typing import Literal
+
+from fastapi import APIRouter
+from maimai_py import PlayerIdentifier
+from pydantic import BaseModel
+from sqlmodel import select
+
+from otoge_service.exceptions import LeporidException
+from otoge_service.models import UsagiCardSync
+from otoge_service.providers.usagicard import UsagiCardProvider
+from otoge_service.sessions import async_session_ctx, get_settings
+
+router = APIRouter()
+settings = get_settings()
+
+
+class UsagiCardSyncRequest(BaseModel):
+    uuid: str
+    source: Literal["divingfish", "lxns", "arcade"]
+    identifier: PlayerIdentifier
+
+
+@router.post("/syncs")
+async def register_usagicard_sync(request: UsagiCardSyncRequest):
+    uuid = UsagiCardProvider()._check_uuid(PlayerIdentifier(credentials=request.uuid))
+    now = datetime.utcnow()
+    async with async_session_ctx() as session:
+        registration = (await session.exec(select(UsagiCardSync).where(UsagiCardSync.uuid == uuid))).first()
+        if registration is None:
+            # the first sync is spread over an interval, so a bulk registration doesn't hit upstream at once
+            first_sync_at = now + timedelta(seconds=random.uniform(0, settings.usagicard_sync_interval))
+            registration = UsagiCardSync(uuid=uuid, source=request.source, identifier="", next_sync_at=first_sync_at)
+        registration.source = request.source
+        registration.identifier = json.dumps(asdict(request.identifier))
+        registration.enabled, registration.last_error, registration.last_active_at = True, None, now
+        session.add(registration)
+        await session.commit()
+
+
+@router.delete("/syncs/{uuid}")
+async def unregister_usagicard_sync(uuid: str):
+    async with async_session_ctx() as session:
+        if registration := (await session.exec(select(UsagiCardSync).where(UsagiCardSync.uuid == uuid))).first():
+            await session.delete(registration)
+            await session.commit()
+            return
+    raise LeporidException.NOT_FOUND.msg("未找到该 UUID 的同步任务")
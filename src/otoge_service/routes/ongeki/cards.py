@@ -1,13 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import col, select
 
 from otoge_service.models import OngekiCard
+from otoge_service.routes.assets import asset_version
 from otoge_service.sessions import async_session_ctx
 
 router = APIRouter()
 
 
-@router.get("/cards", response_model=list[OngekiCard])
+@router.get("/cards", response_model=list[OngekiCard], dependencies=[Depends(asset_version("ongeki-cards"))])
 async def get_ongeki_cards(
     id: int | None = None,
     name: str | None = None,
@@ -1,13 +1,14 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
 from otoge_service.models import OngekiSkill
+from otoge_service.routes.assets import asset_version
 from otoge_service.sessions import async_session_ctx
 
 router = APIRouter()
 
 
-@router.get("/skills", response_model=list[OngekiSkill])
+@router.get("/skills", response_model=list[OngekiSkill], dependencies=[Depends(asset_version("ongeki-skills"))])
 async def get_ongeki_skills(
     id: int | None = None,
     type: str | None = None,
@@ -1,53 +1,275 @@
+import asyncio
 import contextlib
+import hashlib
+import re
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any
 from urllib.parse import unquote, urlparse
 
-import httpx
-from aiocache import RedisCache
-from aiocache.serializers import PickleSerializer
-from maimai_py import MaimaiClient
-from maimai_py.utils.sentinel import UNSET
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlmodel import SQLModel, select
+from sqlalchemy import Connection, inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import SQLModel, col, or_, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from otoge_service.models import Developer
+from otoge_service.loggings import Ansi, log
+from otoge_service.models import Developer, MaimaiScore
 from otoge_service.settings import get_settings
 
+if TYPE_CHECKING:
+    import httpx
+    from maimai_py import MaimaiClient
+    from redis.asyncio import Redis
+
+    from otoge_service.shards import HashRing
+
 settings = get_settings()
 
-async_engine = create_async_engine(settings.database_url)
-httpx_client = httpx.AsyncClient(timeout=httpx.Timeout(None))
+# columns added to tables after they were released, as create_all never alters a table that already exists.
+# table -> column -> SQL expression filling the column of existing rows (None to leave it NULL)
+added_columns: dict[str, dict[str, str | None]] = {
+    "tbl_developer": {"rate_limit_capacity": None, "rate_limit_refill_rate": None, "updated_at": "created_at"},
+}
+
+
+# Clients are created on first use, so workers don't pay for the ones their enabled subsystems never touch.
+@lru_cache(maxsize=1)
+def get_async_engine() -> AsyncEngine:
+    return create_async_engine(settings.database_url)
+
+
+# shard URL -> engine, each shard has its own pool (the main database shares the engine above)
+shard_engines: dict[str, AsyncEngine] = {}
+
+
+def get_shard_engine(url: str) -> AsyncEngine:
+    if url == settings.database_url:
+        return get_async_engine()
+    if (engine := shard_engines.get(url)) is None:
+        engine = shard_engines[url] = create_async_engine(url)
+    return engine
+
+
+@lru_cache(maxsize=2)
+def get_shard_ring(previous: bool = False) -> "HashRing":
+    from otoge_service.shards import HashRing
+
+    return HashRing(list(settings.score_shards_previous if previous else settings.score_shards))
+
+
+def get_score_engine(uuid: str, previous: bool = False) -> AsyncEngine:
+    """Route the scores of a usagicard UUID to its shard, or to the main database if sharding is disabled."""
+    shards = settings.score_shards_previous if previous else settings.score_shards
+    if not shards:
+        return get_async_engine()
+    return get_shard_engine(shards[get_shard_ring(previous).node_of(uuid)])
+
+
+def is_resharding(uuid: str) -> bool:
+    """Whether the scores of the UUID may still live on its shard of the previous shard configuration."""
+    return bool(settings.score_shards_previous) and get_score_engine(uuid, previous=True) is not get_score_engine(uuid)
+
+
+async def dispose_engines() -> None:
+    await get_async_engine().dispose()
+    for engine in shard_engines.values():
+        await engine.dispose()
+
+
+def _get_event_hooks() -> dict[str, list]:
+    from otoge_service.usages import record_upstream
+
+    event_hooks: dict[str, list] = {"request": [record_upstream], "response": []}
+    if settings.enable_flight_recorder:
+        from otoge_service.traces import trace_upstream_request, trace_upstream_response
+
+        event_hooks["request"].append(trace_upstream_request)
+        event_hooks["response"].append(trace_upstream_response)
+    return event_hooks
+
+
+@lru_cache(maxsize=1)
+def get_httpx_client() -> "httpx.AsyncClient":
+    import httpx
+
+    return httpx.AsyncClient(timeout=httpx.Timeout(None), event_hooks=_get_event_hooks())
+
+
+@lru_cache(maxsize=1)
+def get_redis_client() -> "Redis | None":
+    if not settings.redis_url:
+        return None
+    from redis.asyncio import Redis
+
+    return Redis.from_url(settings.redis_url)
+
+
+@lru_cache(maxsize=1)
+def get_redis_backend() -> Any:
+    from maimai_py.utils.sentinel import UNSET
+
+    if not settings.redis_url:
+        return UNSET
+    from aiocache import RedisCache
+    from aiocache.serializers import PickleSerializer
 
-redis_backend = UNSET
-if settings.redis_url:
     redis_url = urlparse(settings.redis_url)
-    redis_backend = RedisCache(
+    return RedisCache(
         serializer=PickleSerializer(),
         endpoint=unquote(redis_url.hostname or "localhost"),
         port=redis_url.port or 6379,
         password=redis_url.password,
         db=int(unquote(redis_url.path).replace("/", "")),
     )
-maimai_client = MaimaiClient(cache=redis_backend)
 
-enabled_developer_tokens: set[str] = set()
+
+@lru_cache(maxsize=1)
+def get_maimai_client() -> "MaimaiClient":
+    from maimai_py import MaimaiClient
+
+    return MaimaiClient(cache=get_redis_backend(), event_hooks=_get_event_hooks())
+
+
+# token hash -> developer, refreshed incrementally from rows updated after the watermark
+enabled_developer_tokens: dict[str, Developer] = {}
+developer_token_hashes: dict[int | None, str] = {}
+developers_watermark: datetime | None = None
+developers_channel = "otoge-service:developers"
+
+token_hash_pattern = re.compile(r"^[0-9a-f]{64}$")
+# rows are re-read from this long before the watermark, as their stamps come from several hosts (or by hand)
+# and transactions may commit out of order, applying a developer twice is harmless
+DEVELOPERS_WATERMARK_MARGIN = timedelta(minutes=5)
 
 
 @contextlib.asynccontextmanager
-async def async_session_ctx():
-    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+async def async_session_ctx(shard_key: str | None = None, previous: bool = False):
+    """Open a session on the main database, or on the score shard of `shard_key` (a usagicard UUID) if given."""
+    engine = get_async_engine() if shard_key is None else get_score_engine(shard_key, previous)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 
+def _add_missing_columns(conn: Connection) -> None:
+    inspector = inspect(conn)
+    for table_name, columns in added_columns.items():
+        table = SQLModel.metadata.tables[table_name]
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        for name, backfill in columns.items():
+            if name in existing:
+                continue
+            # added as nullable, NOT NULL can't be added to a table with rows on every database
+            column_type = table.c[name].type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+            if backfill is not None:
+                conn.execute(text(f"UPDATE {table_name} SET {name} = {backfill}"))
+            for index in table.indexes:
+                if name in index.columns:
+                    index.create(conn, checkfirst=True)
+            log(f"Added column {name} to {table_name}", Ansi.LCYAN)
+
+
 async def init_db():
     import otoge_service.models  # noqa: F401
 
-    async with async_engine.begin() as conn:
+    async with get_async_engine().begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+    # shards only store scores, the other tables stay on the main database
+    for url in {*settings.score_shards.values(), *settings.score_shards_previous.values()} - {settings.database_url}:
+        async with get_shard_engine(url).begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all, tables=[MaimaiScore.__table__])
+    for url in {settings.database_url, *settings.score_shards.values(), *settings.score_shards_previous.values()}:
+        await _add_score_chart_index(get_shard_engine(url))
+
+
+async def _add_score_chart_index(engine: AsyncEngine) -> None:
+    # tables created before the index existed get it here, unless they already hold duplicated charts
+    index = next(index for index in MaimaiScore.__table__.indexes if index.name == "uq_tbl_maimai_scores_chart")  # type: ignore
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(index.create, checkfirst=True)
+    except Exception as e:
+        log(f"Failed to add the unique chart index to {engine.url.render_as_string()}, merge the duplicated scores first: {e!r}", Ansi.LRED)
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _apply_developers(developers: list[Developer]) -> None:
+    global developers_watermark
+    for dev in developers:
+        if (previous_token := developer_token_hashes.pop(dev.id, None)) is not None:
+            enabled_developer_tokens.pop(previous_token, None)
+        if dev.enabled:
+            enabled_developer_tokens[dev.token] = dev
+            developer_token_hashes[dev.id] = dev.token
+        changed_at = max(dev.created_at, dev.updated_at)
+        if developers_watermark is None or changed_at > developers_watermark:
+            developers_watermark = changed_at
 
 
 async def init_developers():
     async with async_session_ctx() as session:
-        developers = await session.exec(select(Developer).where(Developer.enabled == True))
-        global enabled_developer_tokens
-        enabled_developer_tokens = set(dev.token for dev in developers.all() if dev.enabled)
+        developers = (await session.exec(select(Developer))).all()
+        for dev in developers:
+            if not token_hash_pattern.match(dev.token):
+                # tokens stored before hashing was introduced are hashed in place
+                dev.token = hash_token(dev.token)
+                session.add(dev)
+        await session.commit()
+    enabled_developer_tokens.clear()
+    developer_token_hashes.clear()
+    _apply_developers(list(developers))
+
+
+async def refresh_developers():
+    """Apply the developers created or updated since the watermark to the token cache.
+
+    Deleted rows are only noticed by the next full reload, so developers should be disabled rather than deleted.
+    """
+    if developers_watermark is None:
+        return await init_developers()
+    since = developers_watermark - DEVELOPERS_WATERMARK_MARGIN
+    async with async_session_ctx() as session:
+        clause = select(Developer).where(or_(col(Developer.updated_at) >= since, col(Developer.created_at) >= since))
+        _apply_developers(list((await session.exec(clause)).all()))
+
+
+async def watch_developers():
+    """Refresh the token cache every interval, or as soon as a change is published over redis.
+
+    The cache is fully reloaded every full refresh interval, which also drops developers deleted from the table.
+    """
+    pubsub = None
+    loaded_at = time.monotonic()
+    if (redis_client := get_redis_client()) is not None:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(developers_channel)
+        except Exception as e:
+            log(f"Failed to subscribe developer changes, polling only: {e!r}", Ansi.LRED)
+            pubsub = None
+    try:
+        while True:
+            if pubsub is not None:
+                try:
+                    await pubsub.get_message(timeout=settings.developer_refresh_interval)
+                except Exception as e:
+                    log(f"Failed to receive developer changes: {e!r}", Ansi.LRED)
+                    await asyncio.sleep(settings.developer_refresh_interval)
+            else:
+                await asyncio.sleep(settings.developer_refresh_interval)
+            try:
+                if time.monotonic() - loaded_at >= settings.developer_full_refresh_interval:
+                    await init_developers()
+                    loaded_at = time.monotonic()
+                else:
+                    await refresh_developers()
+            except Exception as e:
+                log(f"Failed to refresh developers: {e!r}", Ansi.LRED)
+    finally:
+        if pubsub is not None:
+            await pubsub.aclose()
@@ -13,21 +13,63 @@ class Settings(BaseSettings):
     bind_port: int = 8200
     redis_url: str | None = None
     database_url: str = f"sqlite+aiosqlite:///database.db"
+    score_shards: dict[str, str] = {}
+    score_shards_previous: dict[str, str] = {}
+    profile_startup: bool = False
+
+    # flight recorder settings
+    enable_flight_recorder: bool = False
+    flight_recorder_sample_rate: float = 0.1
+    flight_recorder_threshold: float = 1.0
+    flight_recorder_size: int = 256
+    flight_recorder_path: str | None = None
+    flight_recorder_admin_token: str | None = None
 
     # maimai.py settings
     lxns_developer_token: str | None = None
     divingfish_developer_token: str | None = None
     arcade_proxy: str | None = None
+    maimai_providers: list[str] = ["divingfish", "lxns", "wechat", "arcade", "usagicard"]
+
+    # upstream cache settings
+    enable_upstream_cache: bool = False
+    upstream_cache_ttls: dict[str, float] = {"players": 60.0, "scores": 30.0, "bests": 30.0}
+    upstream_cache_stale: float = 300.0
+    upstream_cache_size: int = 4096
 
     # developer settings
     enable_developer_check: bool = False
     enable_developer_apply: bool = False
+    developer_refresh_interval: float = 5.0
+    developer_full_refresh_interval: float = 600.0
+    usage_flush_interval: float = 30.0
+    usage_bucket_seconds: int = 3600
+
+    # rate limit settings
+    enable_rate_limit: bool = False
+    rate_limit_capacity: int = 60
+    rate_limit_refill_rate: float = 1.0
+    max_concurrent_requests: int = 0
 
     # assets settings
     enable_maimai_assets: bool = False
     enable_ongeki_assets: bool = False
     enable_chunithm_assets: bool = False
 
+    # usagicard settings
+    usagicard_write_behind: bool = False
+    usagicard_write_behind_delay: float = 2.0
+
+    # usagicard sync settings
+    enable_usagicard_sync: bool = False
+    usagicard_sync_interval: float = 3600.0
+    usagicard_sync_idle_interval: float = 86400.0
+    usagicard_sync_active_window: float = 604800.0
+    usagicard_sync_jitter: float = 0.2
+    usagicard_sync_concurrency: int = 4
+    usagicard_sync_budgets: dict[str, float] = {"divingfish": 1.0, "lxns": 1.0, "arcade": 0.2}
+    usagicard_sync_tick: float = 10.0
+
 
 @lru_cache(maxsize=1)
 def get_settings() -> Settings:
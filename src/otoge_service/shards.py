@@ -0,0 +1,92 @@
+import bisect
+import hashlib
+import time
+
+from sqlalchemy import delete, distinct
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import col, select
+
+from otoge_service import sessions
+from otoge_service.loggings import Ansi, log, magnitude_fmt_time
+from otoge_service.models import MaimaiScore
+from otoge_service.providers.usagicard import SCORE_WRITE_ATTEMPTS
+from otoge_service.settings import get_settings
+
+settings = get_settings()
+
+
+class HashRing:
+    """Consistent hash ring of shard names, each placed at `vnodes` points on the ring.
+
+    A key belongs to the first point clockwise from its hash, so keys spread evenly over the shards
+    and adding or removing a shard only moves the keys of the points it gains or loses.
+    """
+
+    def __init__(self, nodes: list[str], vnodes: int = 64) -> None:
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+    def node_of(self, key: str) -> str:
+        return self._nodes[bisect.bisect(self._hashes, self._hash(key)) % len(self._nodes)]
+
+
+async def move_player(uuid: str) -> int:
+    """Merge the scores of the player on its previous shard into its current shard, then delete them from the previous one.
+
+    Scores written to the current shard meanwhile are merged with `MaimaiScore.merge_mpy` rather than overwritten,
+    so moving a player again after an interruption is harmless. Returns the number of scores moved.
+    """
+    select_scores = select(MaimaiScore).where(col(MaimaiScore.uuid) == uuid)
+    async with sessions.async_session_ctx(uuid, previous=True) as source:
+        scores = list(await source.exec(select_scores))
+        for attempt in range(SCORE_WRITE_ATTEMPTS):
+            try:
+                async with sessions.async_session_ctx(uuid) as target:
+                    existing = {(s.song_id, s.type, s.level_index): s for s in await target.exec(select_scores.with_for_update())}
+                    for score in scores:
+                        if (old_score := existing.get((score.song_id, score.type, score.level_index))) is not None:
+                            old_score.merge_mpy(score.as_mpy())
+                        else:
+                            target.add(MaimaiScore.model_validate(score.model_dump(exclude={"id"})))
+                    await target.commit()
+                break
+            except IntegrityError:
+                # a worker inserted the same chart meanwhile, the unique chart index makes us merge into it instead
+                if attempt == SCORE_WRITE_ATTEMPTS - 1:
+                    raise
+        await source.exec(delete(MaimaiScore).where(col(MaimaiScore.uuid) == uuid))  # type: ignore
+        await source.commit()
+    return len(scores)
+
+
+async def reshard(dry_run: bool = False) -> int:
+    """Move the players whose shard differs between `score_shards_previous` and `score_shards`.
+
+    Run it once every worker serves the current shards, those read both shards of a player until it is moved.
+    Returns the number of players moved (or to be moved on a dry run).
+    """
+    if not settings.score_shards_previous:
+        raise ValueError("OTOGE_SERVICE_SCORE_SHARDS_PREVIOUS must list the shards to move players from")
+    await sessions.init_db()
+    begin, players, scores = time.perf_counter_ns(), 0, 0
+    for url in set(settings.score_shards_previous.values()):
+        async with sessions.get_shard_engine(url).connect() as conn:
+            uuids = (await conn.execute(select(distinct(MaimaiScore.uuid)))).scalars().all()
+        for uuid in uuids:
+            # leftovers of players not owned by this shard are never read, so they are left alone
+            if sessions.get_score_engine(uuid, previous=True) is not sessions.get_shard_engine(url) or not sessions.is_resharding(uuid):
+                continue
+            players += 1
+            if not dry_run:
+                scores += await move_player(uuid)
+    elapsed = magnitude_fmt_time(time.perf_counter_ns() - begin)
+    if dry_run:
+        log(f"Found {players} players to move in {elapsed}", Ansi.LGREEN)
+    else:
+        log(f"Moved {players} players ({scores} scores) in {elapsed}", Ansi.LGREEN)
+    return players
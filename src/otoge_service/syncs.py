@@ -0,0 +1,158 @@
+import asyncio
+import json
+import random
+import typing
+from datetime import datetime, timedelta
+
+from maimai_py import ArcadeProvider, DivingFishProvider, IScoreProvider, LXNSProvider, PlayerIdentifier
+from sqlalchemy import Row, bindparam, case, select, update
+
+from otoge_service import ratelimits
+from otoge_service.loggings import Ansi, log
+from otoge_service.models import UsagiCardSync
+from otoge_service.providers.usagicard import UsagiCardProvider, player_activity
+from otoge_service.sessions import get_async_engine, get_maimai_client
+from otoge_service.settings import get_settings
+
+settings = get_settings()
+table = UsagiCardSync.__table__  # type: ignore
+
+SYNC_LEASE = timedelta(minutes=10)  # a claimed player is retried after the lease if its worker dies mid-sync
+
+# same providers as the sources of the chain route, wechat is left out as its cookies expire within minutes
+source_providers: dict[str, typing.Callable[[], IScoreProvider]] = {
+    "divingfish": lambda: DivingFishProvider(developer_token=settings.divingfish_developer_token),
+    "lxns": lambda: LXNSProvider(developer_token=settings.lxns_developer_token),
+    "arcade": lambda: ArcadeProvider(http_proxy=settings.arcade_proxy),
+}
+
+
+def next_sync_at(last_active_at: datetime, now: datetime) -> datetime:
+    """Players active within the window are synced every interval, others every idle interval, both jittered."""
+    active = now - last_active_at < timedelta(seconds=settings.usagicard_sync_active_window)
+    interval = settings.usagicard_sync_interval if active else settings.usagicard_sync_idle_interval
+    jitter = settings.usagicard_sync_jitter
+    return now + timedelta(seconds=interval * random.uniform(1 - jitter, 1 + jitter))
+
+
+async def flush_activity() -> None:
+    """Write the players read since the last flush, and bring the next sync of players waking up from idle forward."""
+    if not player_activity:
+        return
+    now, activity = datetime.utcnow(), dict(player_activity)
+    player_activity.clear()
+    due = bindparam("b_next_sync_at")
+    stmt = (
+        update(table)
+        .where(table.c.uuid == bindparam("b_uuid"))
+        .values(last_active_at=bindparam("b_last_active_at"), next_sync_at=case((table.c.next_sync_at > due, due), else_=table.c.next_sync_at))
+    )
+    rows = [{"b_uuid": uuid, "b_last_active_at": active_at, "b_next_sync_at": next_sync_at(active_at, now)} for uuid, active_at in activity.items()]
+    async with get_async_engine().begin() as conn:
+        await conn.execute(stmt, rows)  # executemany
+
+
+async def claim_due(limit: int) -> list[Row]:
+    """Claim up to `limit` due players, most recently active first.
+
+    Each player is claimed by moving its next sync past the lease only if nobody moved it meanwhile,
+    so workers running the scheduler side by side never sync the same player twice.
+    """
+    now = datetime.utcnow()
+    stmt = select(table).where(table.c.enabled, table.c.next_sync_at <= now).order_by(table.c.last_active_at.desc()).limit(limit)
+    claimed = []
+    async with get_async_engine().begin() as conn:
+        for row in (await conn.execute(stmt)).all():
+            claim = update(table).where(table.c.id == row.id, table.c.next_sync_at == row.next_sync_at).values(next_sync_at=now + SYNC_LEASE)
+            if (await conn.execute(claim)).rowcount == 1:
+                claimed.append(row)
+    return claimed
+
+
+async def _reschedule(id: int, **values: typing.Any) -> None:
+    async with get_async_engine().begin() as conn:
+        await conn.execute(update(table).where(table.c.id == id).values(**values))
+
+
+async def sync_player(row: Row) -> None:
+    """Fetch the scores of the player from its source and merge them into usagicard, like the chain route does."""
+    now = datetime.utcnow()
+    if (budget := settings.usagicard_sync_budgets.get(row.source)) is not None:
+        if (wait := await ratelimits.take(f"sync:{row.source}", 1, budget)) > 0:
+            # the upstream budget is spent, give the slot back and retry the player once a token is available
+            await _reschedule(row.id, next_sync_at=now + timedelta(seconds=wait * random.uniform(1, 2)))
+            return
+
+    errors: list[BaseException] = []
+
+    def callback(scores, error: BaseException | None, kwargs: dict) -> None:
+        if error is not None:
+            errors.append(error)
+
+    try:
+        await get_maimai_client().updates_chain(
+            [(source_providers[row.source](), PlayerIdentifier(**json.loads(row.identifier)), {})],
+            [(UsagiCardProvider(), PlayerIdentifier(credentials=row.uuid), {})],
+            source_callback=callback,
+            target_callback=callback,
+        )
+    except Exception as e:
+        errors.append(e)
+    if errors:
+        log(f"Failed to sync usagicard player {row.uuid} from {row.source}: {errors[0]!r}", Ansi.LYELLOW)
+        await _reschedule(row.id, next_sync_at=next_sync_at(row.last_active_at, now), last_error=repr(errors[0])[:255])
+    else:
+        await _reschedule(row.id, next_sync_at=next_sync_at(row.last_active_at, now), last_error=None, last_synced_at=now)
+
+
+async def _sync_player_logged(row: Row, slot: str) -> None:
+    try:
+        await sync_player(row)
+    except Exception as e:
+        log(f"Failed to reschedule usagicard player {row.uuid}, retrying after the lease: {e!r}", Ansi.LRED)
+    finally:
+        await ratelimits.release("sync:running", slot)
+
+
+async def _acquire_slots(limit: int) -> list[str]:
+    # slots are shared by the workers through redis if configured, a slot left by a dead worker expires with the lease
+    slots: list[str] = []
+    while len(slots) < limit:
+        if (slot := await ratelimits.acquire("sync:running", settings.usagicard_sync_concurrency, SYNC_LEASE.total_seconds())) is None:
+            break
+        slots.append(slot)
+    return slots
+
+
+async def run_scheduler() -> None:
+    """Start due syncs whenever a slot is free, up to `usagicard_sync_concurrency` across the workers."""
+    running: set[asyncio.Task] = set()
+    try:
+        while True:
+            try:
+                await flush_activity()
+                slots = await _acquire_slots(settings.usagicard_sync_concurrency - len(running))
+                rows: list[Row] = []
+                try:
+                    if slots:
+                        rows = await claim_due(len(slots))
+                finally:
+                    # slots without a due player are given back right away
+                    for slot in slots[len(rows) :]:
+                        await ratelimits.release("sync:running", slot)
+                for row, slot in zip(rows, slots):
+                    task = asyncio.create_task(_sync_player_logged(row, slot))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+            except Exception as e:
+                log(f"Failed to schedule usagicard syncs: {e!r}", Ansi.LRED)
+            # jittered so workers started together don't poll in lockstep, and woken early once a slot frees up
+            tick = settings.usagicard_sync_tick * random.uniform(0.5, 1.5)
+            if running:
+                await asyncio.wait(running, timeout=tick, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(tick)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import random
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.requests import Request
+from starlette.responses import Response
+
+from otoge_service.loggings import Ansi, log
+from otoge_service.settings import get_settings
+
+settings = get_settings()
+
+STATEMENT_LENGTH = 500
+whitespace_pattern = re.compile(r"\s+")
+
+
+@dataclass
+class Span:
+    kind: str  # middleware, sql, upstream, lock or serialization
+    name: str
+    start_ms: float
+    duration_ms: float | None = None  # left empty if the span never finished, e.g. an upstream call that failed
+
+
+@dataclass
+class Trace:
+    method: str
+    path: str
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    status_code: int | None = None
+    duration_ms: float | None = None
+    spans: list[Span] = field(default_factory=list)
+    begin: int = field(default_factory=time.perf_counter_ns, repr=False)
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter_ns() - self.begin) / 1e6, 3)
+
+    def open(self, kind: str, name: str) -> Span:
+        span = Span(kind, name, self._elapsed_ms())
+        self.spans.append(span)
+        return span
+
+    def close(self, span: Span) -> None:
+        span.duration_ms = round(self._elapsed_ms() - span.start_ms, 3)
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("begin")
+        data["started_at"] = self.started_at.isoformat()
+        return data
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+# sampled requests slower than the threshold, oldest dropped first
+recorded_traces: deque[dict] = deque(maxlen=settings.flight_recorder_size)
+# JSON lines waiting to be appended to `flight_recorder_path` by a single writer task, oldest dropped first
+pending_lines: deque[str] = deque(maxlen=settings.flight_recorder_size)
+dump_task: asyncio.Task | None = None
+
+
+@contextmanager
+def span(kind: str, name: str):
+    if (trace := current_trace.get()) is None:
+        yield
+        return
+    trace_span = trace.open(kind, name)
+    try:
+        yield
+    finally:
+        trace.close(trace_span)
+
+
+@asynccontextmanager
+async def traced_lock(lock: asyncio.Lock, name: str):
+    with span("lock", name):
+        await lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _write_lines(path: str, lines: list[str]) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+async def dump_pending_lines() -> None:
+    # the file is written in a thread, so a slow disk never blocks the event loop
+    global dump_task
+    try:
+        while pending_lines:
+            lines = list(pending_lines)
+            pending_lines.clear()
+            try:
+                await asyncio.to_thread(_write_lines, settings.flight_recorder_path, lines)  # type: ignore
+            except OSError as e:
+                log(f"Failed to dump {len(lines)} traces: {e!r}", Ansi.LRED)
+    finally:
+        dump_task = None
+
+
+def record(trace: Trace) -> None:
+    global dump_task
+    data = trace.as_dict()
+    recorded_traces.append(data)
+    if settings.flight_recorder_path:
+        pending_lines.append(json.dumps(data, ensure_ascii=False) + "\n")
+        if dump_task is None:
+            dump_task = asyncio.create_task(dump_pending_lines())
+
+
+class FlightRecorderMiddleware(BaseHTTPMiddleware):
+    """Trace a sample of requests, and record those slower than `flight_recorder_threshold` seconds."""
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        if random.random() >= settings.flight_recorder_sample_rate:
+            return await call_next(request)
+        trace = Trace(request.method, request.url.path)
+        token = current_trace.set(trace)
+        try:
+            response = await call_next(request)
+            trace.status_code = response.status_code
+            return response
+        finally:
+            current_trace.reset(token)
+            trace.duration_ms = trace._elapsed_ms()
+            if trace.duration_ms >= settings.flight_recorder_threshold * 1000:
+                record(trace)
+
+
+async def trace_upstream_request(request: httpx.Request) -> None:
+    # httpx request hook, the span is closed by the response hook once the response headers arrive
+    if (trace := current_trace.get()) is not None:
+        request.extensions["trace_span"] = (trace, trace.open("upstream", f"{request.method} {request.url.host}{request.url.path}"))
+
+
+async def trace_upstream_response(response: httpx.Response) -> None:
+    if (traced := response.request.extensions.get("trace_span")) is not None:
+        trace, trace_span = traced
+        trace.close(trace_span)
+        trace_span.name += f" {response.status_code}"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if (trace := current_trace.get()) is not None:
+        statement = whitespace_pattern.sub(" ", statement)[:STATEMENT_LENGTH]
+        conn.info.setdefault("trace_spans", []).append((trace, trace.open("sql", statement)))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if trace_spans := conn.info.get("trace_spans"):
+        trace, trace_span = trace_spans.pop()
+        trace.close(trace_span)
+
+
+def _handle_error(exception_context) -> None:
+    # a failed statement is left unfinished in its trace
+    if exception_context.connection is not None and (trace_spans := exception_context.connection.info.get("trace_spans")):
+        trace_spans.pop()
+
+
+def install() -> None:
+    """Time the SQL statements of every engine, the upstream calls are traced by hooks of the http clients."""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
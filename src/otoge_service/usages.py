@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+
+import httpx
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from otoge_service.loggings import Ansi, log
+from otoge_service.models import DeveloperUsage
+from otoge_service.sessions import get_async_engine
+from otoge_service.settings import get_settings
+
+settings = get_settings()
+
+# (token, route, bucket timestamp) -> [requests, upstream calls]
+usage_counters: defaultdict[tuple[str, str, int], list[int]] = defaultdict(lambda: [0, 0])
+current_usage: ContextVar[tuple[str, str, int] | None] = ContextVar("current_usage", default=None)
+
+
+def record_request(token: str, route: str) -> None:
+    now = int(time.time())
+    usage_key = (token, route, now - now % settings.usage_bucket_seconds)
+    usage_counters[usage_key][0] += 1
+    current_usage.set(usage_key)
+
+
+async def record_upstream(request: httpx.Request) -> None:
+    # httpx request hook, tasks spawned while handling a request inherit its usage key
+    if (usage_key := current_usage.get()) is not None:
+        usage_counters[usage_key][1] += 1
+
+
+def _upsert_usages(dialect: str, rows: list[dict]):
+    table = DeveloperUsage.__table__  # type: ignore
+    if dialect == "mysql":
+        stmt = mysql.insert(table).values(rows)
+        return stmt.on_duplicate_key_update(
+            requests=table.c.requests + stmt.inserted.requests,
+            upstream_calls=table.c.upstream_calls + stmt.inserted.upstream_calls,
+        )
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    stmt = insert(table).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["token", "route", "bucket"],
+        set_={
+            "requests": table.c.requests + stmt.excluded.requests,
+            "upstream_calls": table.c.upstream_calls + stmt.excluded.upstream_calls,
+        },
+    )
+
+
+async def flush_usages() -> None:
+    """Write the usages counted since the last flush in one batch upsert."""
+    global usage_counters
+    if not usage_counters:
+        return
+    counters, usage_counters = usage_counters, defaultdict(lambda: [0, 0])
+    rows = [
+        {
+            "token": token,
+            "route": route,
+            "bucket": datetime.utcfromtimestamp(bucket),
+            "requests": requests,
+            "upstream_calls": upstream_calls,
+        }
+        for (token, route, bucket), (requests, upstream_calls) in counters.items()
+    ]
+    try:
+        async_engine = get_async_engine()
+        async with async_engine.begin() as conn:
+            await conn.execute(_upsert_usages(async_engine.dialect.name, rows))
+    except BaseException:
+        # keep the counts for the next flush
+        for usage_key, (requests, upstream_calls) in counters.items():
+            usage_counters[usage_key][0] += requests
+            usage_counters[usage_key][1] += upstream_calls
+        raise
+
+
+async def flush_usages_periodically() -> None:
+    while True:
+        await asyncio.sleep(settings.usage_flush_interval)
+        try:
+            await flush_usages()
+        except Exception as e:
+            log(f"Failed to flush developer usages: {e!r}", Ansi.LRED)